@@ -1,10 +1,13 @@
 """
 Implements the class TemplateProcessor
 """
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import re
-from pyDOE import lhs  # type: ignore
-from scipy import stats  # type: ignore
+from types import MappingProxyType
+from scipy.spatial.distance import pdist  # type: ignore
+from scipy.special import ndtr, ndtri  # type: ignore
+from scipy.stats import qmc  # type: ignore
 
 import numpy as np  # type: ignore # noqa: F401
 import pandas as pd  # type: ignore # noqa: F401
@@ -36,7 +39,7 @@ class TemplateProcessor:
     set_output_file(output_file_path)
         Sets the output file path.
     set_encoding(encoding)
-        Sets the encoding used for reading and writting files.
+        Sets the encoding used for writting the generated files.
     set_n_samples(n_samples)
         Sets the number of samples to be generated.
     read_variables_table(variables_table_path)
@@ -45,13 +48,49 @@ class TemplateProcessor:
         Sets a variable to active/inactive.
     generate_experiments(n_samples=0, all_uniform=None):
         Generates a table (experiments_table) with all experiments.
-    create_new_files(output_file_path=None):
+    create_new_files(output_file_path=None, n_workers=None):
         Creates files based on samples.
     """
 
+    _VALID_DISTRIBUTIONS = MappingProxyType({
+        'uniform':      {'parameters': 2,
+                         'description': ('minimum', 'maximum'),
+                         'types': ('int', 'float')},
+        'normal':       {'parameters': 2,
+                         'description': ('mean', 'std_var'),
+                         'types': ('float',)},
+        'truncnormal':  {'parameters': 4,
+                         'description': ('mean', 'std_var', 'minimum', 'maximum'),
+                         'types': ('float',)},
+        'lognormal':    {'parameters': 2,
+                         'description': ('mean', 'std_var'),
+                         'types': ('float',)},
+        'triangular':   {'parameters': 3,
+                         'description': ('minimum', 'maximum', 'most_likelly'),
+                         'types': ('float',)},
+        'constant':     {'parameters': 1,
+                         'description': ('value',),
+                         'types': ('int', 'float', 'str')},
+        'categorical':  {'parameters': 2,
+                         'description': ('values_list', 'probabilities_list'),
+                         'types': ('int', 'float', 'str')},
+        'table':        {'parameters': 0,
+                         'description': ('no parameters',),
+                         'types': ('str',)}
+    })
+    _RE_PAREN = re.compile(r'\((.*?)\)')
+    _RE_BRACKET = re.compile(r'\[(.*?)\]')
+    _RE_VAR = re.compile(r'<\\var>(.*?)<var>')
+    # Commas only split if followed by closed pairs up to the end
+    _RE_SPLIT_BRACE = re.compile(r',(?=(?:[^{}]*\{[^{}]*\})*[^{}]*\Z)')
+    _RE_SPLIT_PAREN = re.compile(r',(?=(?:[^()]*\([^()]*\))*[^()]*\Z)')
+    # Closed pairs, removed to find unbalanced delimiters
+    _RE_PAIR_BRACE = re.compile(r'\{[^{}]*\}')
+    _RE_PAIR_PAREN = re.compile(r'\([^()]*\)')
+
     def __init__(self, template_path, verbose=False, output_file_path=None,
                  variables_table_path=None, all_uniform=False, n_samples=0,
-                 encoding='utf-8'):
+                 encoding='utf-8', seed=None):
         """
         Parameters
         ----------
@@ -77,6 +116,10 @@ class TemplateProcessor:
         encoding : str, optional
             Encoding used for read and writting files.
             (default: 'utf-8')
+        seed : int, optional
+            Seed for the random number generator used to
+            build the experiments.
+            (default: None)
         """
 
         self._template_path = Path(template_path)
@@ -87,33 +130,11 @@ class TemplateProcessor:
         self._verbose = verbose
         self._all_uniform = all_uniform
         self._encoding = encoding
+        self._rng = np.random.default_rng(seed)
+        # newline='' keeps the template line endings in the generated files
+        with open(self._template_path, 'r', encoding=encoding, newline='') as f:
+            self._template_text = f.read()
 
-        self._valid_distributions = {
-            'uniform':      {'parameters': 2,
-                             'description': ('minimum', 'maximum'),
-                             'types': ['int', 'float']},
-            'normal':       {'parameters': 2,
-                             'description': ('mean', 'std_var'),
-                             'types': ['float']},
-            'truncnormal':  {'parameters': 4,
-                             'description': ('mean', 'std_var', 'minimum', 'maximum'),
-                             'types': ['float']},
-            'lognormal':    {'parameters': 2,
-                             'description': ('mean', 'std_var'),
-                             'types': ['float']},
-            'triangular':   {'parameters': 3,
-                             'description': ('minimum', 'maximum', 'most_likelly'),
-                             'types': ['float']},
-            'constant':     {'parameters': 1,
-                             'description': ('value',),
-                             'types': ['int', 'float', 'str']},
-            'categorical':  {'parameters': 2,
-                             'description': ('values_list', 'probabilities_list'),
-                             'types': ['int', 'float', 'str']},
-            'table':        {'parameters': 0,
-                             'description': ('no parameters',),
-                             'types': ['str']}
-        }
         # std_dev from mean to define limits of normal distribution variables when
         # using option all_uniform=True
         self._normal_limits_as_uniform = 2.
@@ -138,54 +159,42 @@ class TemplateProcessor:
     def list_valid_distributions(self):
         """Lists all valid distribuition and respective arguments."""
 
-        for k, v in self._valid_distributions.items():
+        for k, v in self._VALID_DISTRIBUTIONS.items():
             msg1 = f"{
                 k} distribution - parameters: {', '.join(v['description'])};"
             msg2 = f"valid type(s): {', '.join(v['types'])}"
             print(" ".join([msg1, msg2]))
 
-    def _extract_contents(self, text, start=r'\(', end=r'\)'):
-        pattern = f'{start}(.*?){end}'
-        matches = re.findall(pattern, text)
-        return matches
-
-    def _custom_split(self, text, sep=',', start='{', end='}'):
-        result = []
-        current_token = ''
-        paren_count = 0
-
-        for char in text:
-            if char == sep and paren_count == 0:
-                result.append(current_token.strip())
-                current_token = ''
-            elif char == start:
-                paren_count += 1
-                current_token += char
-            elif char == end:
-                paren_count -= 1
-                current_token += char
-            else:
-                current_token += char
-
-        result.append(current_token.strip())
-        return result
+    def _custom_split(self, text, parentheses=False):
+        # Splits text at the commas outside { } pairs, or outside
+        # ( ) pairs if parentheses is True
+        if parentheses:
+            delimiters = '()'
+            pair_pattern, split_pattern = self._RE_PAIR_PAREN, self._RE_SPLIT_PAREN
+        else:
+            delimiters = '{}'
+            pair_pattern, split_pattern = self._RE_PAIR_BRACE, self._RE_SPLIT_BRACE
+        unpaired = pair_pattern.sub('', text)
+        if delimiters[0] in unpaired or delimiters[1] in unpaired:
+            raise ValueError(
+                f"Unclosed {delimiters[0]} {delimiters[1]} in: '{text}'.")
+        return [token.strip() for token in split_pattern.split(text)]
 
     def _extract_raw_text(self):
         variables_raw = []
-        with open(self._template_path, 'r', encoding=self._encoding) as file:
-            for line_num, line in enumerate(file, start=1):
-                if line.count(r'<\var>') != line.count('<var>'):
-                    raise ValueError(
-                        f"Unclosed <\\var> <var> at line {line_num}.")
-                parts = self._extract_contents(
-                    text=line, start=r'<\\var>', end=r'<var>')
-                if len(parts) > 0:
-                    for part in parts:
-                        var = part.strip()
-                        if var == '':
-                            raise ValueError(
-                                f"Empty variable name at line {line_num}.")
-                        variables_raw.append(var)
+        lines = self._template_text.splitlines()
+        for line_num, line in enumerate(lines, start=1):
+            if line.count(r'<\var>') != line.count('<var>'):
+                raise ValueError(
+                    f"Unclosed <\\var> <var> at line {line_num}.")
+            parts = self._RE_VAR.findall(line)
+            if len(parts) > 0:
+                for part in parts:
+                    var = part.strip()
+                    if var == '':
+                        raise ValueError(
+                            f"Empty variable name at line {line_num}.")
+                    variables_raw.append(var)
         return variables_raw
 
     def _transform_variable(self, variable, variable_type):
@@ -205,6 +214,22 @@ class TemplateProcessor:
         except (ValueError, TypeError, NameError):
             return None
 
+    def _transform_column(self, values, variable_type):
+        # Casts a whole column at once and returns its text representation
+        values = np.asarray(values)
+        try:
+            var_type = {'int': np.int64,
+                        'str': np.str_,
+                        'float': np.float64}[variable_type.strip().lower()]
+            if var_type is np.int64 and values.dtype.kind == 'f':
+                # NaN, inf and out of range values fail the comparison
+                if not (np.abs(values) < 2.**63).all():
+                    raise ValueError("Values out of int range.")
+            return values.astype(var_type).astype(str).tolist()
+        except (ValueError, TypeError, KeyError, OverflowError):
+            # OverflowError comes from Python ints wider than int64
+            return [str(self._transform_variable(v, variable_type)) for v in values]
+
     def _parse_distribution(self, text, var_type):
         if text is None:
             if self._verbose:
@@ -213,20 +238,20 @@ class TemplateProcessor:
 
         parameters = self._custom_split(text)
         distribution = parameters[0].lower()
-        if distribution not in self._valid_distributions:
+        if distribution not in self._VALID_DISTRIBUTIONS:
             raise ValueError(f"Invalid distribution: '{distribution}'.")
         parameters = parameters[1:]
-        if len(parameters) != self._valid_distributions[distribution]['parameters']:
-            expected = self._valid_distributions[distribution]['parameters']
+        if len(parameters) != self._VALID_DISTRIBUTIONS[distribution]['parameters']:
+            expected = self._VALID_DISTRIBUTIONS[distribution]['parameters']
             msg1 = f"Invalid number of parameters for distribution '{
                 distribution}'."
             msg2 = f" Expected {expected}, found {len(parameters)}."
             raise ValueError(" ".join([msg1, msg2]))
 
         if var_type is not None:
-            if var_type not in self._valid_distributions[distribution]['types']:
+            if var_type not in self._VALID_DISTRIBUTIONS[distribution]['types']:
                 types = ', '.join(
-                    self._valid_distributions[distribution]['types'])
+                    self._VALID_DISTRIBUTIONS[distribution]['types'])
                 msg1 = f"Invalid type ({var_type})"
                 msg2 = f"for distribution '{distribution}'."
                 msg3 = f"Valid option(s): {types}."
@@ -275,16 +300,17 @@ class TemplateProcessor:
                     msg2 = f"must be of type float. Cannot transform '{p}'."
                     raise ValueError(" ".join([msg1, msg2]))
                 param_list[i] = new_value
-            s = sum(param_list)
-            cum_list = [sum(param_list[:i+1]) /
-                        s for i in range(len(param_list))]
-            parameters[1] = cum_list
+            cum_list = np.cumsum(param_list)
+            parameters[1] = cum_list / cum_list[-1]
+            # cumulative probabilities used when all_uniform=True
+            n = len(param_list)
+            parameters.append(np.arange(1, n + 1) / n)
 
         return distribution, parameters
 
     def _check_variable_type(self, default, distribution, parameters):
         var_type = None
-        for test_type in self._valid_distributions[distribution]['types']:
+        for test_type in self._VALID_DISTRIBUTIONS[distribution]['types']:
             if var_type is None:
                 var_type = test_type
 
@@ -316,14 +342,13 @@ class TemplateProcessor:
         default = None
         var_type = None
 
-        distribution_text = self._extract_contents(
-            text=text, start=r'\(', end=r'\)')
+        distribution_text = self._RE_PAREN.findall(text)
         if len(distribution_text) > 1:
             msg1 = f"Bad distribution options format in: '{text}'."
             msg2 = "Only one distribution with ( and ) can be defined."
             raise ValueError(" ".join([msg1, msg2]))
 
-        options = self._custom_split(text=text, start='(', end=')')
+        options = self._custom_split(text=text, parentheses=True)
         if len(distribution_text) == 1:
             if '(' not in options[-1] or ')' not in options[-1]:
                 msg1 = "Distribution options with ( and ) must be"
@@ -360,7 +385,7 @@ class TemplateProcessor:
             msg1 = "Couldn't find the variable type based on provided data: "
             msg2 = f"'{text}'. Possible type(s) for {distribution} are:"
             msg3 = f"{
-                ', '.join(self._valid_distributions[distribution]['types'])}."
+                ', '.join(self._VALID_DISTRIBUTIONS[distribution]['types'])}."
             raise ValueError(" ".join([msg1, msg2, msg3]))
 
         return {'active': True,
@@ -376,7 +401,7 @@ class TemplateProcessor:
         return key
 
     def _parse_options(self, text):
-        options = self._extract_contents(text=text, start=r'\[', end=r'\]')
+        options = self._RE_BRACKET.findall(text)
         if len(options) > 1:
             msg1 = f"Bad options format in: '{text}'."
             msg2 = "Only one list with [ and ] can be defined."
@@ -435,12 +460,15 @@ class TemplateProcessor:
                                  str(output_file_path)}') from exc
 
     def set_encoding(self, encoding):
-        """Sets the encoding used for reading and writting files.
+        """Sets the encoding used for writting the generated files.
+
+        The template file is read only once, with the encoding
+        passed when the TemplateProcessor is created.
 
         Parameters
         ----------
         encoding : str
-            Encoding used for reading and writting files.
+            Encoding used for writting the generated files.
 
         """
         self._encoding = encoding
@@ -543,63 +571,73 @@ class TemplateProcessor:
             return parameters[0]
 
         if distribution == 'categorical':
-            if all_uniform:
-                n = len(parameters[0])
-                p_cum_list = [(i+1) / n for i in range(n)]
+            values = np.asarray(parameters[0])
+            n = len(values)
+            p_cum_list = parameters[2] if all_uniform else parameters[1]
+            # first category whose cumulative probability is >= probability;
+            # clipped to guard against rounding in the last cumulative value
+            index = np.searchsorted(p_cum_list, probability, side='left')
+            return values[np.minimum(index, n - 1)]
+
+        if all_uniform and distribution in ('triangular', 'normal',
+                                            'truncnormal', 'lognormal'):
+            if distribution == 'triangular':
+                loc = parameters[0]
+                scale = parameters[1] - parameters[0]
+            elif distribution == 'truncnormal':
+                loc = parameters[2]
+                scale = parameters[3] - parameters[2]
             else:
-                p_cum_list = parameters[1]
-
-            def cat_prob(x):
-                for i, p in enumerate(p_cum_list):
-                    if p >= x:
-                        return parameters[0][i]
-                raise ValueError("Error in categorical probabilities!")
-            vec_cat_prob = np.vectorize(cat_prob)
-            return vec_cat_prob(probability)
+                std_dev = parameters[1]
+                loc = parameters[0] - std_dev * self._normal_limits_as_uniform
+                scale = 2 * std_dev * self._normal_limits_as_uniform
+            return loc + scale * probability
 
-        if distribution == 'uniform' or (distribution == 'triangular' and all_uniform):
+        if distribution == 'uniform':
             loc = parameters[0]
             scale = parameters[1] - parameters[0]
             if isinstance(loc, int) and isinstance(scale, int):
-                return np.int32(stats.randint.ppf(probability, low=loc, high=loc+scale+1))
-            return stats.uniform.ppf(probability, loc=loc, scale=scale)
+                values = np.ceil(probability * (scale + 1)) + loc - 1
+                return np.int32(np.clip(values, loc, loc + scale))
+            return loc + scale * probability
 
         if distribution == 'triangular':
             loc = parameters[0]
             scale = parameters[1] - parameters[0]
-            c = (parameters[2] - parameters[0]) / scale
-            return stats.triang.ppf(probability, c, loc=loc, scale=scale)
+            mode = parameters[2]
+            c = (mode - loc) / scale
+            return np.where(probability < c,
+                            loc + np.sqrt(probability * scale * (mode - loc)),
+                            loc + scale - np.sqrt((1 - probability) * scale *
+                                                  (parameters[1] - mode)))
 
         if distribution == 'normal':
             mean = parameters[0]
             std_dev = parameters[1]
-            if all_uniform:
-                loc = mean - std_dev * self._normal_limits_as_uniform
-                scale = 2 * std_dev * self._normal_limits_as_uniform
-                return stats.uniform.ppf(probability, loc=loc, scale=scale)
-            return stats.norm.ppf(probability, loc=mean, scale=std_dev)
+            return mean + std_dev * ndtri(probability)
 
         if distribution == 'truncnormal':
             mean = parameters[0]
             std_dev = parameters[1]
             a = parameters[2]
             b = parameters[3]
-            if all_uniform:
-                return stats.uniform.ppf(probability, loc=a, scale=b-a)
             lower_limit = (a - mean) / std_dev
             upper_limit = (b - mean) / std_dev
-            return stats.truncnorm.ppf(probability,
-                                       lower_limit, upper_limit,
-                                       loc=mean, scale=std_dev)
+            if lower_limit > 0:
+                # mirrored form keeps precision in the upper tail
+                sf_lower = ndtr(-lower_limit)
+                sf_upper = ndtr(-upper_limit)
+                values = mean - std_dev * ndtri(sf_lower - probability * (sf_lower - sf_upper))
+            else:
+                cdf_lower = ndtr(lower_limit)
+                cdf_upper = ndtr(upper_limit)
+                values = mean + std_dev * ndtri(cdf_lower + probability * (cdf_upper - cdf_lower))
+            return np.clip(values, a, b)
 
         if distribution == 'lognormal':
             mean = parameters[0]
             std_dev = parameters[1]
-            if all_uniform:
-                loc = mean - std_dev * self._normal_limits_as_uniform
-                scale = 2 * std_dev * self._normal_limits_as_uniform
-                return stats.uniform.ppf(probability, loc=loc, scale=scale)
-            return stats.lognorm.ppf(probability, s=std_dev, scale=np.exp(mean))
+            return np.exp(mean + std_dev * ndtri(probability))
 
         raise ValueError(f"Unknown distribution: {distribution}.")
 
@@ -630,6 +668,23 @@ class TemplateProcessor:
                 f"Cannot deactivate a variable without a default value: {variable}.")
         self.variables[variable]['default'] = active
 
+    def _lhs_maximin(self, n_variables, n_samples, iterations):
+        # Latin hypercube with one random point per stratum in each column.
+        # Keeps the design with the largest minimum distance between samples.
+        strata = np.arange(n_samples)[:, np.newaxis]
+        best_samples = None
+        best_distance = -1.
+        for _ in range(iterations):
+            samples = self._rng.random((n_samples, n_variables))
+            samples = self._rng.permuted((samples + strata) / n_samples, axis=0)
+            if n_samples < 2:
+                return samples
+            distance = pdist(samples).min()
+            if distance > best_distance:
+                best_distance = distance
+                best_samples = samples
+        return best_samples
+
     def generate_experiments(self, n_samples=0, all_uniform=None):
         """Generates a table (experiments_table) with all experiments.
 
@@ -661,37 +716,51 @@ class TemplateProcessor:
             iterations = 1
         else:
             iterations = min(100, max(1, int(1e6*np.power(n_samples, -2.))))
-        samples = lhs(len(self.variables),
-                      samples=n_samples,
-                      criterion='maximin',
-                      iterations=iterations)
+        if iterations <= 1:
+            sampler = qmc.LatinHypercube(d=len(self.variables), seed=self._rng)
+            samples = sampler.random(n=n_samples)
+        else:
+            samples = self._lhs_maximin(len(self.variables), n_samples, iterations)
 
         if self._verbose:
             print('Calculating inverse CDF')
-        df = pd.DataFrame()
+        columns = {}
         for column_index, var in enumerate(self.variables):
             data = self.variables[var]
             if self._verbose:
                 print(f'   {var}: {data['distribution']}')
             if not data['active']:
-                df[var] = [data['default']] * n_samples
+                columns[var] = np.full(n_samples, data['default'])
             elif data['distribution'] == 'table':
-                df[var] = data['values']
+                columns[var] = data['values']
+            else:
+                values = self._inv_cdf(samples[:, column_index], data, all_uniform)
+                if np.ndim(values) == 0:
+                    values = np.full(n_samples, values)
+                columns[var] = values
+        self.experiments_table = pd.DataFrame(columns, copy=False)
+
+    def _compile_template(self, text):
+        # Turns text into a format string with one positional field per
+        # variable. Returns it with the variable names in field order.
+        parts = self._RE_VAR.split(text)
+        positions = {}
+        segments = []
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                segments.append(part.replace('{', '{{').replace('}', '}}'))
             else:
-                df[var] = self._inv_cdf(
-                    samples[:, column_index], data, all_uniform)
-        self.experiments_table = df
-
-    def _create_new_file(self, output_file_path, values, text):
-        new_text = text
-        for var, data in self.variables.items():
-            pattern = f'<\\\\var>{var}[^<]+<var>'
-            value = self._transform_variable(values[var], data['type'])
-            new_text = re.sub(pattern, str(value), new_text)
-        with open(output_file_path, 'w', encoding=self._encoding) as f:
-            f.write(new_text)
-
-    def create_new_files(self, output_file_path=None):
+                key = self._parse_key(part.strip())
+                position = positions.setdefault(key, len(positions))
+                segments.append(f'{{{position}}}')
+        return ''.join(segments), list(positions)
+
+    def _create_new_file(self, output_file_path, text):
+        data = text.encode(self._encoding)
+        with open(output_file_path, 'wb') as f:
+            f.write(data)
+
+    def create_new_files(self, output_file_path=None, n_workers=None):
         """Creates files based on samples.
 
         Parameters
@@ -700,6 +769,10 @@ class TemplateProcessor:
             Path to the files to be writen. Uses value stored
             in output_file_path if None is provided.
             (default: None)
+        n_workers : int, optional
+            Number of threads used to write the files. Uses
+            the ThreadPoolExecutor default if None is provided.
+            (default: None)
         """
 
         if output_file_path is not None:
@@ -713,12 +786,21 @@ class TemplateProcessor:
                 print('Experiments table could not be created. Cannot continue.')
                 return
 
-        with open(self._template_path, 'r', encoding=self._encoding) as f:
-            text = f.read()
+        template, keys = self._compile_template(self._template_text)
+        columns = {k: self._transform_column(self.experiments_table[k].to_numpy(),
+                                             self.variables[k]['type'])
+                   for k in self.experiments_table.columns}
 
-        self._output_file_path.parent.mkdir(parents=True, exist_ok=True)
-        for index, row in self.experiments_table.iterrows():
+        def write_file(i, index):
             file_name = f"{self._output_file_path.stem}_{
                 index}{self._output_file_path.suffix}"
             new_file_path = self._output_file_path.with_name(file_name)
-            self._create_new_file(new_file_path, row.to_dict(), text)
+            text = template.format(*[columns[key][i] for key in keys])
+            self._create_new_file(new_file_path, text)
+
+        self._output_file_path.parent.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # consuming the results re-raises errors from the workers
+            list(executor.map(write_file,
+                              range(len(self.experiments_table)),
+                              self.experiments_table.index))
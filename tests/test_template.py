@@ -196,6 +196,46 @@ class TestTemplate(unittest.TestCase):
             self.assertTrue(np.max(data) <= v['max'],
                             f"Failed to calculate max for '{k}': {np.max(data)} > {v['max']}")
 
+    def test_truncnormal_tails(self):
+        """Checks truncated normals with limits far from the mean"""
+        limits_list = [(6, 8), (9, 10), (-10, -9)]
+
+        n_samples = 500
+        for lower, upper in limits_list:
+            text = rf'<\var>var[float,{lower},(truncnormal,0,1,{lower},{upper})]<var>'
+            templ = process_temporary_file(text=text, verbose=False)
+            templ.generate_experiments(n_samples)
+            data = templ.experiments_table['var'].to_numpy()
+            k = f'truncnormal 0, 1, {lower}, {upper}'
+
+            self.assertTrue(np.isfinite(data).all(),
+                            f"Non finite values for '{k}'.")
+            self.assertTrue(np.min(data) >= lower,
+                            f"Failed to calculate min for '{k}': {np.min(data)} < {lower}")
+            self.assertTrue(np.max(data) <= upper,
+                            f"Failed to calculate max for '{k}': {np.max(data)} > {upper}")
+            # mapping back with scipy's CDF must keep one sample per stratum
+            probability = truncnorm.cdf(data, lower, upper, loc=0, scale=1)
+            strata = np.sort(np.floor(probability * n_samples))
+            self.assertTrue(np.array_equal(strata, np.arange(n_samples)),
+                            f"Samples of '{k}' do not follow scipy's truncnorm.")
+
+    def test_latin_hypercube(self):
+        """Checks that each variable has one sample per stratum"""
+        text = [
+            r'<\var>var1[float,1,(uniform,0,1)]<var>',
+            r'<\var>var2[float,1,(uniform,0,1)]<var>',
+            r'<\var>var3[float,1,(uniform,0,1)]<var>',
+        ]
+
+        n_samples = 50
+        templ = process_temporary_file(text='\n'.join(text), verbose=False)
+        templ.generate_experiments(n_samples)
+        for k, data in templ.experiments_table.items():
+            strata = np.sort(np.floor(data.to_numpy() * n_samples))
+            self.assertTrue(np.array_equal(strata, np.arange(n_samples)),
+                            f"Samples of '{k}' are not stratified.")
+
     def test_generate_files(self):
         """Test file generation based on template"""
         text = [
@@ -232,6 +272,56 @@ class TestTemplate(unittest.TestCase):
             self.assertTrue(Path(temp_dir / file_name).exists(), msg)
         delete_temp_folder(temp_dir=temp_dir)
 
+    def test_file_contents(self):
+        """Test values written in the generated files"""
+        text = [
+            r'var1 = <\var>var1<var>',
+            r'var10 = {<\var>var10[int,1,(constant,7)]<var>}',
+            r'var1 again = <\var> var1 <var>',
+        ]
+
+        df = pd.DataFrame()
+        df['var1'] = ['a', 'b', 'c']
+
+        temp_dir = Path(tempfile.mkdtemp())
+        output_file_path = temp_dir / 'test.dat'
+        _ = process_temporary_file(text='\n'.join(text),
+                                   verbose=False,
+                                   variables_df=df,
+                                   output_file_path=output_file_path)
+
+        for k, value in enumerate(df['var1']):
+            file_name = f"{output_file_path.stem}_{k}{output_file_path.suffix}"
+            with open(temp_dir / file_name, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            expected = [f'var1 = {value}', 'var10 = {7}', f'var1 again = {value}']
+            self.assertEqual(lines, expected, f'Wrong contents in {file_name}.')
+        delete_temp_folder(temp_dir=temp_dir)
+
+    def test_large_int_contents(self):
+        """Test int values wider than 64 bits in the generated files"""
+        big = 99999999999999999999
+        text = [
+            rf'A <\var>a[int,1,(constant,{big})]<var>',
+            rf'B <\var>b[int,1,(categorical,{{{big},{big}}},{{1,1}})]<var>',
+        ]
+
+        n_samples = 3
+        temp_dir = Path(tempfile.mkdtemp())
+        output_file_path = temp_dir / 'test.dat'
+        _ = process_temporary_file(text='\n'.join(text),
+                                   verbose=False,
+                                   output_file_path=output_file_path,
+                                   n_samples=n_samples)
+
+        for k in range(n_samples):
+            file_name = f"{output_file_path.stem}_{k}{output_file_path.suffix}"
+            with open(temp_dir / file_name, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            expected = [f'A {big}', f'B {big}']
+            self.assertEqual(lines, expected, f'Wrong contents in {file_name}.')
+        delete_temp_folder(temp_dir=temp_dir)
+
     def test_error_catching(self):
         """Test error catching"""
         error_list = {
@@ -256,6 +346,21 @@ class TestTemplate(unittest.TestCase):
             with self.assertRaises(ValueError, msg=msg):
                 _ = process_temporary_file(v)
 
+    def test_unclosed_delimiters(self):
+        """Test unbalanced { } and ( ) in variable options"""
+        error_list = {
+            'unclosed brace': r'<\var>var[int,1,(categorical,{1,2},{0.5,0.5)]<var>',
+            'unopened brace': r'<\var>var[int,1,(categorical,{1,2},0.5,0.5})]<var>',
+            'unclosed parenthesis': r'<\var>var[float,1.5,(normal,0,2.5]<var>',
+            'misordered braces': r'<\var>var[int,1,(categorical,}1,2{,{0.5,0.5})]<var>',
+            'misordered parentheses': r'<\var>var[float,1.5,)normal,0,2.5(]<var>',
+        }
+
+        for k, v in error_list.items():
+            msg = f'Could not catch the "{k}" error.'
+            with self.assertRaisesRegex(ValueError, 'Unclosed', msg=msg):
+                _ = process_temporary_file(v)
+
 
 if __name__ == '__main__':
     unittest.main()